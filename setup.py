@@ -1,9 +1,21 @@
 """
 setup.py
 """
+import os
 
 from setuptools import setup, find_packages
 
+# Optionally compile the request routing module with Cython, falling back to the
+# pure-Python module when SATOSA_CYTHON is not set or Cython is not installed.
+ext_modules = []
+if os.environ.get("SATOSA_CYTHON") == "1":
+    try:
+        from Cython.Build import cythonize
+    except ImportError:
+        pass
+    else:
+        ext_modules = cythonize(["src/satosa/routing.py"], compiler_directives={"language_level": "3"})
+
 setup(
     name='SATOSA',
     version='8.1.0',
@@ -14,6 +26,7 @@ setup(
     url='https://github.com/SUNET/SATOSA',
     packages=find_packages('src/'),
     package_dir={'': 'src'},
+    ext_modules=ext_modules,
     install_requires=[
         "pyop >= 3.3.1",
         "pysaml2 >= 6.5.1",
@@ -28,10 +28,22 @@ class BackendModule(object):
         """
         self.auth_callback_func = auth_callback_func
         self.internal_attributes = internal_attributes
-        self.converter = AttributeMapper(internal_attributes)
+        self.converter = self._create_converter(internal_attributes)
         self.base_url = base_url
         self.name = name
 
+    def _create_converter(self, internal_attributes):
+        """
+        Creates the attribute mapper used by the backend.
+
+        :type internal_attributes: dict[string, dict[str, str | list[str]]]
+        :rtype: satosa.attribute_mapping.AttributeMapper
+
+        :param internal_attributes: the internal attribute mapping
+        :return: attribute mapper
+        """
+        return AttributeMapper(internal_attributes)
+
     def start_auth(self, context, internal_request):
         """
         This is the start up function of the backend authorization.
@@ -3,8 +3,11 @@ A saml2 backend module for the satosa proxy
 """
 import copy
 import functools
+import hmac
 import json
 import logging
+import re
+import secrets
 import warnings as _warnings
 from base64 import urlsafe_b64encode
 from urllib.parse import urlparse
@@ -20,6 +23,7 @@ from saml2.samlp import Scoping
 
 import satosa.logging_util as lu
 import satosa.util as util
+from satosa.attribute_mapping import AttributeMapper
 from satosa.base import SAMLBaseModule
 from satosa.base import SAMLEIDASBaseModule
 from satosa.base import STATE_KEY as STATE_KEY_BASE
@@ -37,6 +41,63 @@ from satosa.backends.base import BackendModule
 
 logger = logging.getLogger(__name__)
 
+# top-level sp_config entries whose nested values pysaml2 can write to: the loaded SPConfig keeps
+# references to the values under 'service', and MetadataStore.imp sets 'check_validity' on the
+# 'metadata' entries
+_MUTATED_SP_CONFIG_KEYS = {"metadata", "service"}
+
+
+def _clone_sp_config(sp_config):
+    """
+    Copies the sp_config dict so that loading it with pysaml2 does not alter the backend config.
+    Only the entries in _MUTATED_SP_CONFIG_KEYS are deep copied; the rest is shared.
+
+    :type sp_config: dict[str, Any]
+    :rtype: dict[str, Any]
+
+    :param sp_config: the sp_config part of the backend config
+    :return: a copy of the sp_config safe to load with pysaml2
+    """
+    return {
+        key: copy.deepcopy(value) if key in _MUTATED_SP_CONFIG_KEYS else value
+        for key, value in sp_config.items()
+    }
+
+
+# the attribute mapper shared by the SAML backends, keyed by the id of its internal attributes;
+# only the mapper for the most recently loaded internal attributes is kept
+_converter_cache = {}
+
+
+def _shared_converter(internal_attributes):
+    """
+    Returns the attribute mapper for the given internal attributes, shared by all SAML backends
+    created with the same internal attributes object. The proxy loads the internal attributes once
+    and does not modify them afterwards, so the mapper can safely be reused.
+
+    :type internal_attributes: dict[string, dict[str, str | list[str]]]
+    :rtype: satosa.attribute_mapping.AttributeMapper
+
+    :param internal_attributes: the internal attribute mapping
+    :return: attribute mapper
+    """
+    cached = _converter_cache.get(id(internal_attributes))
+    # the mapping is kept in the cache entry so that its id can not be reused by another object
+    if cached is None or cached[0] is not internal_attributes:
+        cached = (internal_attributes, AttributeMapper(internal_attributes))
+        # drop the mapper of previously loaded internal attributes, so that it can be collected
+        _converter_cache.clear()
+        _converter_cache[id(internal_attributes)] = cached
+    return cached[1]
+
+
+def clear_converter_cache():
+    """
+    Discards the attribute mapper shared by the SAML backends, together with the internal attributes
+    it was created for.
+    """
+    _converter_cache.clear()
+
 
 def get_memorized_idp(context, config, force_authn):
     memorized_idp = (
@@ -113,7 +174,7 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
         self.outstanding_queries = {}
         self.idp_blacklist_file = config.get('idp_blacklist_file', None)
 
-        sp_config = SPConfig().load(copy.deepcopy(config[SAMLBackend.KEY_SP_CONFIG]))
+        sp_config = SPConfig().load(_clone_sp_config(config[SAMLBackend.KEY_SP_CONFIG]))
 
         # if encryption_keypairs is defined, use those keys for decryption
         # else, if key_file and cert_file are defined, use them for decryption
@@ -139,6 +200,16 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
 
         # finally, initialize the client object
         self.sp = Saml2Client(sp_config)
+        self._sp_endpoints = self.sp.config.getattr("endpoints", "sp")
+        self._allow_unsolicited = self.sp.config.getattr('allow_unsolicited', 'sp')
+        self._metadata_string = None
+        self._url_map_cache = None
+
+    def _create_converter(self, internal_attributes):
+        """
+        See super class method satosa.backends.base.BackendModule#_create_converter
+        """
+        return _shared_converter(internal_attributes)
 
     def get_idp_entity_id(self, context):
         """
@@ -205,8 +276,7 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
         :param internal_req: The request
         :return: Response
         """
-        endpoints = self.sp.config.getattr("endpoints", "sp")
-        return_url = endpoints["discovery_response"][0][0]
+        return_url = self._sp_endpoints["discovery_response"][0][0]
 
         disco_url = (
             context.get_decoration(SAMLBackend.KEY_SAML_DISCOVERY_SERVICE_URL)
@@ -286,8 +356,8 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             kwargs["scoping"] = Scoping(requester_id=[RequesterID(text=requester)])
 
         try:
-            acs_endp, response_binding = self.sp.config.getattr("endpoints", "sp")["assertion_consumer_service"][0]
-            relay_state = util.rndstr()
+            acs_endp, response_binding = self._sp_endpoints["assertion_consumer_service"][0]
+            relay_state = secrets.token_urlsafe(16)
             req_id, binding, http_info = self.sp.prepare_for_negotiated_authenticate(
                 entityid=entity_id,
                 response_binding=response_binding,
@@ -300,7 +370,7 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             logger.debug(logline, exc_info=True)
             raise SATOSAAuthenticationError(context.state, "Failed to construct the AuthnRequest") from e
 
-        if self.sp.config.getattr('allow_unsolicited', 'sp') is False:
+        if self._allow_unsolicited is False:
             if req_id in self.outstanding_queries:
                 msg = "Request with duplicate id {}".format(req_id)
                 logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
@@ -338,7 +408,7 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             logger.debug(logline, exc_info=True)
             raise SATOSAAuthenticationError(context.state, "Failed to parse authn request") from err
 
-        if self.sp.config.getattr('allow_unsolicited', 'sp') is False:
+        if self._allow_unsolicited is False:
             req_id = authn_response.in_response_to
             if req_id not in self.outstanding_queries:
                 msg = "No request with id: {}".format(req_id),
@@ -348,7 +418,11 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             del self.outstanding_queries[req_id]
 
         # check if the relay_state matches the cookie state
-        if context.state[self.name]["relay_state"] != context.request["RelayState"]:
+        expected_relay_state = context.state[self.name]["relay_state"]
+        relay_state = context.request.get("RelayState") or ""
+        if not expected_relay_state or not hmac.compare_digest(
+            expected_relay_state.encode("utf-8"), relay_state.encode("utf-8")
+        ):
             msg = "State did not match relay state for state"
             logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
             logger.debug(logline)
@@ -432,11 +506,12 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             subject_id=name_id,
         )
 
-        msg = "backend received attributes:\n{}".format(
-            json.dumps(response.ava, indent=4)
-        )
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(state), message=msg)
-        logger.debug(logline)
+        if logger.isEnabledFor(logging.DEBUG):
+            msg = "backend received attributes:\n{}".format(
+                json.dumps(response.ava, indent=4)
+            )
+            logline = lu.LOG_FMT.format(id=lu.get_session_id(state), message=msg)
+            logger.debug(logline)
         return internal_resp
 
     def _metadata_endpoint(self, context):
@@ -448,24 +523,54 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
         :param context: The current context
         :return: response with metadata
         """
-        msg = "Sending metadata response for entityId = {}".format(self.sp.config.entityid)
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-        logger.debug(logline)
+        if logger.isEnabledFor(logging.DEBUG):
+            msg = "Sending metadata response for entityId = {}".format(self.sp.config.entityid)
+            logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+            logger.debug(logline)
 
-        metadata_string = create_metadata_string(None, self.sp.config, 4, None, None, None, None,
-                                                 None).decode("utf-8")
+        metadata_string = self._metadata_string
+        if metadata_string is None:
+            metadata_string = create_metadata_string(None, self.sp.config, 4, None, None, None, None,
+                                                     None).decode("utf-8")
+            # metadata with a validity period has a validUntil relative to its creation time,
+            # so it can only be reused when no validity period is configured
+            if not self.sp.config.valid_for:
+                self._metadata_string = metadata_string
         return Response(metadata_string, content="text/xml")
 
     def register_endpoints(self):
         """
         See super class method satosa.backends.base.BackendModule#register_endpoints
-        :rtype list[(str, ((satosa.context.Context, Any) -> Any, Any))]
+        :rtype list[(re.Pattern, ((satosa.context.Context, Any) -> Any, Any))]
+        """
+        if self._url_map_cache is None:
+            self._url_map_cache = self._build_url_map()
+        return list(self._url_map_cache)
+
+    def clear_endpoints_cache(self):
         """
-        url_map = []
-        sp_endpoints = self.sp.config.getattr("endpoints", "sp")
-        for endp, binding in sp_endpoints["assertion_consumer_service"]:
-            parsed_endp = urlparse(endp)
-            url_map.append(("^%s$" % parsed_endp.path[1:], functools.partial(self.authn_response, binding=binding)))
+        Discards the endpoints built by register_endpoints and the created SP metadata, and reads
+        the SP endpoints and allow_unsolicited from the current configuration, so that the
+        endpoints and metadata are built again from it the next time they are needed.
+        """
+        self._sp_endpoints = self.sp.config.getattr("endpoints", "sp")
+        self._allow_unsolicited = self.sp.config.getattr('allow_unsolicited', 'sp')
+        self._metadata_string = None
+        self._url_map_cache = None
+
+    def _build_url_map(self):
+        """
+        Builds the endpoints of this backend from its configuration.
+
+        :rtype list[(re.Pattern, ((satosa.context.Context, Any) -> Any, Any))]
+        """
+        acs_endpoints = self._sp_endpoints["assertion_consumer_service"]
+        url_map = [
+            (re.compile("^%s$" % re.escape(urlparse(endp).path[1:])),
+             functools.partial(self.authn_response, binding=binding))
+            for endp, binding in acs_endpoints
+        ]
+        for _, binding in acs_endpoints:
             if binding == BINDING_HTTP_REDIRECT:
                 msg = " ".join(
                     [
@@ -482,20 +587,20 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
                 _warnings.warn(msg, UserWarning)
 
         if self.discosrv:
-            for endp, binding in sp_endpoints["discovery_response"]:
-                parsed_endp = urlparse(endp)
-                url_map.append(
-                    ("^%s$" % parsed_endp.path[1:], self.disco_response))
+            url_map.extend(
+                (re.compile("^%s$" % re.escape(urlparse(endp).path[1:])), self.disco_response)
+                for endp, _ in self._sp_endpoints["discovery_response"]
+            )
 
         if self.expose_entityid_endpoint():
             logger.debug("Exposing backend entity endpoint = {}".format(self.sp.config.entityid))
             parsed_entity_id = urlparse(self.sp.config.entityid)
-            url_map.append(("^{0}".format(parsed_entity_id.path[1:]),
+            url_map.append((re.compile("^{0}".format(parsed_entity_id.path[1:])),
                             self._metadata_endpoint))
 
         if self.enable_metadata_reload():
             url_map.append(
-                ("^%s/%s$" % (self.name, "reload-metadata"), self._reload_metadata))
+                (re.compile("^%s/%s$" % (self.name, "reload-metadata")), self._reload_metadata))
 
         return url_map
 
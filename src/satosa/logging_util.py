@@ -6,10 +6,12 @@ def get_session_id(state):
     return session_id
 
 
-def satosa_logging(logger, level, message, state, **kwargs):
+def satosa_logging(logger, level, message, state, *args, **kwargs):
     """
     Adds a session ID to the message.
 
+    The message is only formatted if the logger is enabled for the given level.
+
     :type logger: logging
     :type level: int
     :type message: str
@@ -17,10 +19,15 @@ def satosa_logging(logger, level, message, state, **kwargs):
 
     :param logger: Logger to use
     :param level: Logger level (ex: logging.DEBUG/logging.WARN/...)
-    :param message: Message
+    :param message: Message, optionally a format string for args
     :param state: The current state
+    :param args: arguments merged into message using the % operator
     :param kwargs: set exc_info=True to get an exception stack trace in the log
     """
+    if not logger.isEnabledFor(level):
+        return
+    if args:
+        message = message % args
     session_id = get_session_id(state)
     logline = LOG_FMT.format(id=session_id, message=message)
     logger.log(level, logline, **kwargs)
@@ -1,8 +1,12 @@
 """
 Holds satosa routing logic
 """
+import heapq
 import logging
 import re
+from collections import namedtuple
+from operator import attrgetter
+from urllib.parse import urlparse
 
 from satosa.context import SATOSABadContextError
 from satosa.exception import SATOSAError
@@ -29,15 +33,112 @@ class SATOSAUnknownTargetBackend(SATOSAError):
     pass
 
 
-class ModuleRouter(object):
-    class UnknownEndpoint(ValueError):
-        pass
+_ModuleEntry = namedtuple("_ModuleEntry", ["instance", "endpoints"])
+_IndexedEndpoint = namedtuple("_IndexedEndpoint", ["pos", "prefix", "regex", "spec", "name", "target"])
+
+
+def _compile_endpoints(endpoints):
+    """
+    Compiles the url regexes of registered endpoints once, so that they do not have to be
+    parsed again for every routed request.
+
+    :type endpoints: list[(str | re.Pattern, Any)] | None
+    :rtype: list[(re.Pattern, Any)]
+
+    :param endpoints: endpoints as returned by a module's register_endpoints
+    :return: endpoints with compiled url regexes
+    """
+    return [(re.compile(regex), spec) for regex, spec in endpoints or []]
+
+
+_ENDPOINT_PATH_PREFIX = re.compile(r"\^((?:[\w-]|\\[^\w/])+)(?:/(?![*+?{])|\$)")
+_ESCAPED_CHAR = re.compile(r"\\(\W)")
+_LITERAL_ENDPOINT = re.compile(r"\^((?:[\w/-]|\\\W)*)\$")
+
+
+def _endpoint_path_prefix(regex):
+    """
+    Returns the literal first path segment a compiled endpoint regex is anchored to.
+
+    :type regex: re.Pattern
+    :rtype: str | None
+
+    :param regex: compiled endpoint regex
+    :return: the first path segment, or None if the regex may match paths starting with any segment
+    """
+    if regex.flags & re.IGNORECASE or "|" in regex.pattern:
+        return None
+    match = _ENDPOINT_PATH_PREFIX.match(regex.pattern)
+    return _ESCAPED_CHAR.sub(r"\1", match.group(1)) if match else None
+
+
+def _literal_endpoint_path(regex):
+    """
+    Returns the path a compiled endpoint regex matches if it is a plain anchored literal.
+
+    :type regex: re.Pattern
+    :rtype: str | None
+
+    :param regex: compiled endpoint regex
+    :return: the literal path, or None if the regex is not of the form ^literal$
+    """
+    if regex.flags & re.IGNORECASE:
+        return None
+    match = _LITERAL_ENDPOINT.fullmatch(regex.pattern)
+    return _ESCAPED_CHAR.sub(r"\1", match.group(1)) if match else None
+
+
+def _index_endpoints(endpoints):
+    """
+    Groups endpoints by the first path segment of their regex, keeping the registration order
+    within each group. Endpoints without a literal first path segment are part of every group and
+    are also stored under the key None, which is used for paths not matching any group.
+
+    :type endpoints: list[(re.Pattern, Any, str, str)]
+    :rtype: dict[str | None, list[_IndexedEndpoint]]
+
+    :param endpoints: (regex, spec, module name, context target attribute) in routing order
+    :return: the endpoint index
+    """
+    index = {None: []}
+    for pos, (regex, spec, name, target) in enumerate(endpoints):
+        entry = _IndexedEndpoint(pos, _endpoint_path_prefix(regex), regex, spec, name, target)
+        if entry.prefix is None:
+            for group in index.values():
+                group.append(entry)
+        else:
+            index.setdefault(entry.prefix, list(index[None])).append(entry)
+    return index
+
+
+def _merge_indexed_endpoints(entries, other_entries):
+    """
+    Merges two endpoint index groups into a single group in routing order.
+
+    :type entries: list[_IndexedEndpoint]
+    :type other_entries: list[_IndexedEndpoint]
+    :rtype: Iterator[_IndexedEndpoint]
+
+    :param entries: endpoint index group
+    :param other_entries: another endpoint index group
+    :return: the entries of both groups, each entry only once
+    """
+    last_pos = None
+    for entry in heapq.merge(entries, other_entries, key=attrgetter("pos")):
+        if entry.pos != last_pos:
+            last_pos = entry.pos
+            yield entry
 
+
+class ModuleRouter(object):
     """
     Routes url paths to their bound functions
     and handles the internal routing between frontends and backends.
     """
 
+    __slots__ = ("base_url", "frontends", "backends", "micro_services", "_base_has_ctx_path",
+                 "_base_ctx_segment", "_endpoint_index", "_literal_endpoints")
+
     def __init__(self, base_url, frontends, backends, micro_services):
         """
         :type base_url: str
@@ -57,23 +158,54 @@ class ModuleRouter(object):
             raise ValueError("Base URL is mandatory")
 
         self.base_url = base_url
+        base_path = urlparse(base_url).path.strip("/")
+        self._base_ctx_segment = base_path.split("/")[-1] if base_path else None
+        self._base_has_ctx_path = bool(self._base_ctx_segment)
 
         if not frontends or not backends:
             raise ValueError("Need at least one frontend and one backend")
 
         backend_names = [backend.name for backend in backends]
-        self.frontends = {instance.name: {"instance": instance,
-                                          "endpoints": instance.register_endpoints(backend_names)}
+        self.frontends = {instance.name: _ModuleEntry(instance,
+                                                      _compile_endpoints(instance.register_endpoints(backend_names)))
                           for instance in frontends}
-        self.backends = {instance.name: {"instance": instance, "endpoints": instance.register_endpoints()}
+        self.backends = {instance.name: _ModuleEntry(instance, _compile_endpoints(instance.register_endpoints()))
                          for instance in backends}
 
         if micro_services:
-            self.micro_services = {instance.name: {"instance": instance, "endpoints": instance.register_endpoints()}
+            self.micro_services = {instance.name: _ModuleEntry(instance,
+                                                               _compile_endpoints(instance.register_endpoints()))
                                    for instance in micro_services}
         else:
             self.micro_services = {}
 
+        # frontends take precedence over micro services when routing
+        routed_endpoints = (
+            [(regex, spec, name, "target_frontend")
+             for name, module in self.frontends.items() for regex, spec in module.endpoints]
+            + [(regex, spec, name, "target_micro_service")
+               for name, module in self.micro_services.items() for regex, spec in module.endpoints]
+        )
+        self._endpoint_index = _index_endpoints(routed_endpoints)
+
+        # resolve the routes of literal endpoint paths once, so that requests for them skip regex
+        # matching, and requests for backend endpoints also skip the frontend and micro service lookup
+        literal_paths = {
+            _literal_endpoint_path(regex)
+            for modules in (self.frontends, self.backends, self.micro_services)
+            for module in modules.values() for regex, _ in module.endpoints
+        } - {None}
+        self._literal_endpoints = {}
+        for path in literal_paths:
+            try:
+                backend = self._path_backend(path)
+            except ValueError:
+                # the path lacks the base URL context path, requests for it are rejected before routing
+                continue
+            route = self._route(path, self._strip_base_url_context(path), backend)
+            if route is not None:
+                self._literal_endpoints[path] = route
+
         logger.debug("Using base URL: {}".format(base_url))
         logger.debug("Loaded backends with endpoints: {}".format(backends))
         logger.debug("Loaded frontends with endpoints: {}".format(frontends))
@@ -89,10 +221,11 @@ class ModuleRouter(object):
         :param context: The request context
         :return: backend
         """
-        msg = "Routing to backend: {backend}".format(backend=context.target_backend)
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-        logger.debug(logline)
-        backend = self.backends[context.target_backend]["instance"]
+        if logger.isEnabledFor(logging.DEBUG):
+            msg = "Routing to backend: {backend}".format(backend=context.target_backend)
+            logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+            logger.debug(logline)
+        backend = self.backends[context.target_backend].instance
         context.state[STATE_KEY] = context.target_frontend
         return backend
 
@@ -108,46 +241,82 @@ class ModuleRouter(object):
         """
 
         target_frontend = context.state[STATE_KEY]
-        msg = "Routing to frontend: {frontend}".format(frontend=target_frontend)
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-        logger.debug(logline)
+        if logger.isEnabledFor(logging.DEBUG):
+            msg = "Routing to frontend: {frontend}".format(frontend=target_frontend)
+            logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+            logger.debug(logline)
         context.target_frontend = target_frontend
-        frontend = self.frontends[context.target_frontend]["instance"]
+        frontend = self.frontends[context.target_frontend].instance
         return frontend
 
-    def _find_registered_endpoint_for_module(self, module, context):
-        logger.debug("Using endpoints: {}".format(module["endpoints"]))
-        for regex, spec in module["endpoints"]:
-            context_path = context.path
-            match = re.search(regex, context_path)
-            if match is None and "/" in self.base_url.replace("https://", "").replace("http://", ""):
-                    logger.debug(f"Base URL has a context path: {self.base_url}")
-                    context_path = context_path.replace(self.base_url.split("/")[-1], "")
-                    context_path = context_path.replace("/", "", 1)
-                    logger.debug(f"Removed: {context_path}")
-                    match = re.search(regex, context_path)
-            if match is not None:
-                msg = "Found registered endpoint: module name:'{name}', endpoint: {endpoint}".format(
-                    name=module["instance"].name, endpoint=context.path
-                )
-                logline = lu.LOG_FMT.format(
-                    id=lu.get_session_id(context.state), message=msg
-                )
-                logger.debug(logline)
+    def _path_backend(self, path):
+        path_split = path.split("/")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Found path_splits: {path_split}".format(path_split=path_split))
+        if self._base_has_ctx_path:
+            base_url_context = self._base_ctx_segment
+            path_split.remove(base_url_context)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Found context path: {ctx}, removing. Resulting path split: {path_split}".format(
+                    ctx=base_url_context, path_split=path_split))
+        return path_split[0] if path_split else None
+
+    def _strip_base_url_context(self, path):
+        if not self._base_has_ctx_path:
+            return None
+        path = path.replace(self._base_ctx_segment, "")
+        return path.replace("/", "", 1)
+
+    def _log_found_endpoint(self, name, context):
+        if logger.isEnabledFor(logging.DEBUG):
+            msg = "Found registered endpoint: module name:'{name}', endpoint: {endpoint}".format(
+                name=name, endpoint=context.path
+            )
+            logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+            logger.debug(logline)
+
+    def _find_registered_endpoint_for_module(self, module, path, stripped_path):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Using endpoints: {}".format(module.endpoints))
+        for regex, spec in module.endpoints:
+            if regex.search(path) is not None or (
+                stripped_path is not None and regex.search(stripped_path) is not None
+            ):
                 return spec
 
         return None
 
-    def _find_registered_backend_endpoint(self, context):
-        return self._find_registered_endpoint_for_module(self.backends[context.target_backend], context)
+    def _match_indexed_endpoint(self, path, stripped_path):
+        index = self._endpoint_index
+        prefix = path.split("/", 1)[0]
+        candidates = index.get(prefix, index[None])
+        if stripped_path is None:
+            for entry in candidates:
+                if entry.regex.search(path):
+                    return entry.target, entry.name, entry.spec
+
+            return None
+
+        stripped_prefix = stripped_path.split("/", 1)[0]
+        stripped_candidates = index.get(stripped_prefix, index[None])
+        if stripped_candidates is not candidates:
+            candidates = _merge_indexed_endpoints(candidates, stripped_candidates)
+        for entry in candidates:
+            # an endpoint anchored to a path prefix can only match the variant of the path starting with it
+            if (entry.prefix in (None, prefix) and entry.regex.search(path)) or (
+                entry.prefix in (None, stripped_prefix) and entry.regex.search(stripped_path)
+            ):
+                return entry.target, entry.name, entry.spec
 
-    def _find_registered_endpoint(self, context, modules):
-        for module in modules.values():
-            matched = self._find_registered_endpoint_for_module(module, context)
-            if matched:
-                return module["instance"].name, matched
+        return None
 
-        raise ModuleRouter.UnknownEndpoint(context.path)
+    def _route(self, path, stripped_path, backend):
+        route = self._match_indexed_endpoint(path, stripped_path)
+        if route is None and backend in self.backends:
+            backend_endpoint = self._find_registered_endpoint_for_module(self.backends[backend], path, stripped_path)
+            if backend_endpoint:
+                route = ("target_backend", backend, backend_endpoint)
+        return route
 
     def endpoint_routing(self, context):
         """
@@ -160,52 +329,37 @@ class ModuleRouter(object):
         :return: registered endpoint and bound parameters
         """
         if context.path is None:
-            msg = "Context did not contain a path!"
-            logline = lu.LOG_FMT.format(
-                id=lu.get_session_id(context.state), message=msg
-            )
-            logger.debug(logline)
+            if logger.isEnabledFor(logging.DEBUG):
+                msg = "Context did not contain a path!"
+                logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+                logger.debug(logline)
             raise SATOSABadContextError("Context did not contain any path")
 
-        msg = "Routing path: {path}".format(path=context.path)
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-        logger.debug(logline)
-        path_split = context.path.split("/")
-        logger.debug(f"Found path_splits: {path_split}".format(path_split=path_split))
-        if "/" in self.base_url.replace("https://", "").replace("http://", ""):
-            base_url_context = self.base_url.split("/")[-1]
-            path_split.remove(base_url_context)
-            logger.debug("Found context path: {ctx}, removing. Resulting path split: {path_split}".format(ctx=base_url_context, path_split=path_split))
-        backend = path_split[0]
+        if logger.isEnabledFor(logging.DEBUG):
+            msg = "Routing path: {path}".format(path=context.path)
+            logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+            logger.debug(logline)
+        backend = self._path_backend(context.path)
 
         if backend in self.backends:
             context.target_backend = backend
         else:
-            msg = "Unknown backend {}".format(backend)
-            logline = lu.LOG_FMT.format(
-                id=lu.get_session_id(context.state), message=msg
-            )
-            logger.debug(logline)
-
-        try:
-            name, frontend_endpoint = self._find_registered_endpoint(context, self.frontends)
-        except ModuleRouter.UnknownEndpoint:
-            pass
-        else:
-            context.target_frontend = name
-            return frontend_endpoint
-
-        try:
-            name, micro_service_endpoint = self._find_registered_endpoint(context, self.micro_services)
-        except ModuleRouter.UnknownEndpoint:
-            pass
-        else:
-            context.target_micro_service = name
-            return micro_service_endpoint
-
-        if backend in self.backends:
-            backend_endpoint = self._find_registered_backend_endpoint(context)
-            if backend_endpoint:
-                return backend_endpoint
+            if logger.isEnabledFor(logging.DEBUG):
+                msg = "Unknown backend {}".format(backend)
+                logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+                logger.debug(logline)
 
-        raise SATOSANoBoundEndpointError("'{}' not bound to any function".format(context.path))
+        route = self._literal_endpoints.get(context.path)
+        if route is None:
+            stripped_path = self._strip_base_url_context(context.path)
+            if stripped_path is not None and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Base URL has a context path: {}, also matching endpoints against: {}".format(
+                    self.base_url, stripped_path))
+            route = self._route(context.path, stripped_path, backend)
+        if route is None:
+            raise SATOSANoBoundEndpointError("'{}' not bound to any function".format(context.path))
+
+        target, name, endpoint = route
+        setattr(context, target, name)
+        self._log_found_endpoint(name, context)
+        return endpoint
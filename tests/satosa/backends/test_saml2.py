@@ -1,6 +1,7 @@
 """
 Tests for the SAML frontend module src/backends/saml2.py.
 """
+import copy
 import os
 import re
 from base64 import urlsafe_b64encode
@@ -17,8 +18,9 @@ from saml2.authn_context import PASSWORD
 from saml2.config import IdPConfig, SPConfig
 from saml2.s_utils import deflate_and_base64_encode
 
-from satosa.backends.saml2 import SAMLBackend
+from satosa.backends.saml2 import SAMLBackend, clear_converter_cache
 from satosa.context import Context
+from satosa.exception import SATOSAAuthenticationError
 from satosa.internal import InternalData
 from tests.users import USERS
 from tests.util import FakeIdP, create_metadata_from_config_dict, FakeSP
@@ -103,6 +105,33 @@ class TestSAMLBackend:
         for endp in all_sp_endpoints:
             assert any(p.match(endp) for p in compiled_regex)
 
+    def test_register_endpoints_reuses_built_endpoints(self):
+        url_map = self.samlbackend.register_endpoints()
+        assert self.samlbackend.register_endpoints() == url_map
+
+        with patch("satosa.backends.saml2.urlparse") as mock_urlparse:
+            self.samlbackend.register_endpoints()
+            assert not mock_urlparse.called
+
+            self.samlbackend.clear_endpoints_cache()
+            mock_urlparse.return_value = urlparse("https://sp.example.com/acs")
+            self.samlbackend.register_endpoints()
+            assert mock_urlparse.called
+
+    def test_clear_endpoints_cache_reads_current_sp_config(self, context):
+        self.samlbackend.register_endpoints()
+        assert "new_acs" not in self.samlbackend._metadata_endpoint(context).message
+        endpoints = copy.deepcopy(self.samlbackend.sp.config.getattr("endpoints", "sp"))
+        endpoints["assertion_consumer_service"] = [("https://sp.example.com/new_acs", BINDING_HTTP_REDIRECT)]
+        self.samlbackend.sp.config.setattr("sp", "endpoints", endpoints)
+        self.samlbackend.sp.config.setattr("sp", "allow_unsolicited", True)
+
+        self.samlbackend.clear_endpoints_cache()
+        url_map = self.samlbackend.register_endpoints()
+        assert any(regex.match("new_acs") for regex, _ in url_map)
+        assert "https://sp.example.com/new_acs" in self.samlbackend._metadata_endpoint(context).message
+        assert self.samlbackend._allow_unsolicited is True
+
     def test_start_auth_defaults_to_redirecting_to_discovery_server(self, context, sp_conf):
         resp = self.samlbackend.start_auth(context, InternalData())
         assert_redirect_to_discovery_server(resp, sp_conf, DISCOSRV_URL)
@@ -196,6 +225,46 @@ class TestSAMLBackend:
         assert_authn_response(internal_resp)
         assert self.samlbackend.name not in context.state
 
+    def _make_authn_response(self, idp_conf, sp_conf):
+        fakesp = FakeSP(SPConfig().load(sp_conf))
+        fakeidp = FakeIdP(USERS, config=IdPConfig().load(idp_conf))
+        destination, request_params = fakesp.make_auth_req(idp_conf["entityid"])
+        url, auth_resp = fakeidp.handle_auth_req(request_params["SAMLRequest"], request_params["RelayState"],
+                                                 BINDING_HTTP_REDIRECT,
+                                                 "testuser1", response_binding=BINDING_HTTP_REDIRECT)
+        return auth_resp, request_params["RelayState"]
+
+    @pytest.mark.parametrize("relay_state", ["wrong_relay_state", None])
+    def test_authn_response_with_mismatching_relay_state(self, context, idp_conf, sp_conf, relay_state):
+        auth_resp, expected_relay_state = self._make_authn_response(idp_conf, sp_conf)
+        auth_resp["RelayState"] = relay_state
+        context.request = auth_resp
+        context.state[self.samlbackend.name] = {"relay_state": expected_relay_state}
+        with pytest.raises(SATOSAAuthenticationError):
+            self.samlbackend.authn_response(context, BINDING_HTTP_REDIRECT)
+
+        assert not self.samlbackend.auth_callback_func.called
+
+    def test_authn_response_without_relay_state(self, context, idp_conf, sp_conf):
+        auth_resp, expected_relay_state = self._make_authn_response(idp_conf, sp_conf)
+        del auth_resp["RelayState"]
+        context.request = auth_resp
+        context.state[self.samlbackend.name] = {"relay_state": expected_relay_state}
+        with pytest.raises(SATOSAAuthenticationError):
+            self.samlbackend.authn_response(context, BINDING_HTTP_REDIRECT)
+
+        assert not self.samlbackend.auth_callback_func.called
+
+    def test_authn_response_with_empty_state_relay_state(self, context, idp_conf, sp_conf):
+        auth_resp, _ = self._make_authn_response(idp_conf, sp_conf)
+        del auth_resp["RelayState"]
+        context.request = auth_resp
+        context.state[self.samlbackend.name] = {"relay_state": ""}
+        with pytest.raises(SATOSAAuthenticationError):
+            self.samlbackend.authn_response(context, BINDING_HTTP_REDIRECT)
+
+        assert not self.samlbackend.auth_callback_func.called
+
     @pytest.mark.skipif(
             saml2.__version__ < '4.6.1',
             reason="Optional NameID needs pysaml2 v4.6.1 or higher")
@@ -292,12 +361,52 @@ class TestSAMLBackend:
                                   "base_url", "samlbackend")
         assert samlbackend.encryption_keys
 
+    def test_loaded_sp_config_does_not_share_service_config(self, sp_conf):
+        samlbackend = SAMLBackend(None, INTERNAL_ATTRIBUTES, {"sp_config": sp_conf}, "base_url", "saml_backend")
+        expected_sp_conf = copy.deepcopy(sp_conf)
+        acs_endpoints = samlbackend.sp.config.getattr("endpoints", "sp")["assertion_consumer_service"]
+        acs_endpoints.append(("https://sp.example.com/other_acs", BINDING_HTTP_REDIRECT))
+        assert sp_conf == expected_sp_conf
+
+    def test_converter_is_shared_for_same_internal_attributes(self, sp_conf):
+        samlbackend = SAMLBackend(None, INTERNAL_ATTRIBUTES, {"sp_config": sp_conf}, "base_url", "saml_backend")
+        assert samlbackend.converter is self.samlbackend.converter
+
+        other_attributes = copy.deepcopy(INTERNAL_ATTRIBUTES)
+        samlbackend = SAMLBackend(None, other_attributes, {"sp_config": sp_conf}, "base_url", "saml_backend")
+        assert samlbackend.converter is not self.samlbackend.converter
+
+    def test_converter_is_only_kept_for_latest_internal_attributes(self, sp_conf):
+        SAMLBackend(None, copy.deepcopy(INTERNAL_ATTRIBUTES), {"sp_config": sp_conf}, "base_url", "saml_backend")
+        samlbackend = SAMLBackend(None, INTERNAL_ATTRIBUTES, {"sp_config": sp_conf}, "base_url", "saml_backend")
+        assert samlbackend.converter is not self.samlbackend.converter
+
+    def test_clear_converter_cache(self, sp_conf):
+        clear_converter_cache()
+        samlbackend = SAMLBackend(None, INTERNAL_ATTRIBUTES, {"sp_config": sp_conf}, "base_url", "saml_backend")
+        assert samlbackend.converter is not self.samlbackend.converter
+
     def test_metadata_endpoint(self, context, sp_conf):
         resp = self.samlbackend._metadata_endpoint(context)
         headers = dict(resp.headers)
         assert headers["Content-Type"] == "text/xml"
         assert sp_conf["entityid"] in resp.message
 
+    def test_metadata_endpoint_reuses_created_metadata(self, context):
+        with patch("satosa.backends.saml2.create_metadata_string", return_value=b"<metadata/>") as create_metadata:
+            first = self.samlbackend._metadata_endpoint(context)
+            second = self.samlbackend._metadata_endpoint(context)
+        assert first.message == second.message == "<metadata/>"
+        assert create_metadata.call_count == 1
+
+    def test_metadata_endpoint_recreates_metadata_with_validity_period(self, context, sp_conf):
+        sp_conf["valid_for"] = 24
+        samlbackend = SAMLBackend(None, INTERNAL_ATTRIBUTES, {"sp_config": sp_conf}, "base_url", "saml_backend")
+        with patch("satosa.backends.saml2.create_metadata_string", return_value=b"<metadata/>") as create_metadata:
+            samlbackend._metadata_endpoint(context)
+            samlbackend._metadata_endpoint(context)
+        assert create_metadata.call_count == 2
+
     def test_get_metadata_desc(self, sp_conf, idp_conf):
         sp_conf["metadata"]["inline"] = [create_metadata_from_config_dict(idp_conf)]
         # instantiate new backend, with a single backing IdP
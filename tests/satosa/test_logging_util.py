@@ -0,0 +1,40 @@
+"""
+Tests for the logging helpers in src/satosa/logging_util.py.
+"""
+import logging
+from unittest.mock import Mock
+
+from satosa.logging_util import satosa_logging
+
+
+class Unformattable:
+    def __str__(self):
+        raise AssertionError("the message should not be formatted")
+
+
+class TestSatosaLogging:
+    def test_formats_message_with_args(self):
+        logger = Mock()
+        logger.isEnabledFor.return_value = True
+        state = Mock(session_id="abc123")
+
+        satosa_logging(logger, logging.DEBUG, "Routing path: %s, backend: %s", state, "Saml2SP/acs", "Saml2SP")
+
+        logger.log.assert_called_once_with(logging.DEBUG, "[abc123] Routing path: Saml2SP/acs, backend: Saml2SP")
+
+    def test_message_without_args_is_not_formatted(self):
+        logger = Mock()
+        logger.isEnabledFor.return_value = True
+
+        satosa_logging(logger, logging.WARNING, "100% done", None, exc_info=True)
+
+        logger.log.assert_called_once_with(logging.WARNING, "[UNKNOWN] 100% done", exc_info=True)
+
+    def test_does_not_log_when_level_is_disabled(self):
+        logger = Mock()
+        logger.isEnabledFor.return_value = False
+
+        satosa_logging(logger, logging.DEBUG, "Routing path: %s", None, Unformattable())
+
+        logger.isEnabledFor.assert_called_once_with(logging.DEBUG)
+        assert not logger.log.called
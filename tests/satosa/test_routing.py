@@ -1,7 +1,10 @@
+import re
+
 import pytest
 
 from satosa.context import Context
-from satosa.routing import ModuleRouter, SATOSANoBoundEndpointError
+from satosa.routing import (ModuleRouter, SATOSANoBoundEndpointError, _endpoint_path_prefix, _index_endpoints,
+                            _literal_endpoint_path)
 from tests.util import TestBackend, TestFrontend, TestRequestMicroservice, TestResponseMicroservice
 
 FRONTEND_NAMES = ["Saml2IDP", "VOPaaSSaml2IDP"]
@@ -24,7 +27,7 @@ class TestModuleRouter:
         microservices = [TestRequestMicroservice(request_micro_service_name, base_url="https://satosa.example.com"),
                          TestResponseMicroservice(response_micro_service_name, base_url="https://satosa.example.com")]
 
-        self.router = ModuleRouter(frontends, backends, microservices)
+        self.router = ModuleRouter("https://satosa.example.com", frontends, backends, microservices)
 
     @pytest.mark.parametrize('url_path, expected_frontend, expected_backend', [
         ("%s/%s/request" % (provider, receiver), receiver, provider)
@@ -57,7 +60,7 @@ class TestModuleRouter:
         context.path = url_path
         microservice_callable = self.router.endpoint_routing(context)
         assert context.target_micro_service == expected_micro_service
-        assert microservice_callable == self.router.micro_services[expected_micro_service]["instance"].callback
+        assert microservice_callable == self.router.micro_services[expected_micro_service].instance.callback
         assert context.target_backend is None
         assert context.target_frontend is None
 
@@ -74,9 +77,148 @@ class TestModuleRouter:
         assert context.target_frontend == expected_frontend
 
         backend = self.router.backend_routing(context)
-        assert backend == self.router.backends[expected_backend]["instance"]
+        assert backend == self.router.backends[expected_backend].instance
         frontend = self.router.frontend_routing(context)
-        assert frontend == self.router.frontends[expected_frontend]["instance"]
+        assert frontend == self.router.frontends[expected_frontend].instance
+
+    def test_endpoints_are_compiled_at_init(self):
+        for modules in (self.router.frontends, self.router.backends, self.router.micro_services):
+            for module in modules.values():
+                assert module.endpoints
+                for regex, _ in module.endpoints:
+                    assert isinstance(regex, re.Pattern)
+
+    @pytest.mark.parametrize('url_path, expected_frontend, expected_backend', [
+        ("proxy/%s/%s/request" % (provider, receiver), receiver, provider)
+        for receiver in FRONTEND_NAMES
+        for provider in BACKEND_NAMES
+        ])
+    def test_endpoint_routing_with_base_url_context_path(self, url_path, expected_frontend, expected_backend):
+        router = ModuleRouter("https://satosa.example.com/proxy",
+                              [module.instance for module in self.router.frontends.values()],
+                              [module.instance for module in self.router.backends.values()],
+                              [module.instance for module in self.router.micro_services.values()])
+        context = Context()
+        context.path = url_path
+        router.endpoint_routing(context)
+        assert context.target_frontend == expected_frontend
+        assert context.target_backend == expected_backend
+
+    def test_endpoint_routing_with_base_url_context_path_in_endpoint(self):
+        frontend = TestFrontend(None, {"attributes": {}}, None, None, "Saml2IDP")
+        frontend.register_endpoints = lambda backend_names: [
+            ("^proxy/{}/Saml2IDP/request$".format(name), frontend.handle_request) for name in backend_names
+        ]
+        backend = TestBackend(None, {"attributes": {}}, None, None, "Saml2SP")
+        router = ModuleRouter("https://satosa.example.com/proxy", [frontend], [backend], [])
+
+        context = Context()
+        context.path = "proxy/Saml2SP/Saml2IDP/request"
+        assert router.endpoint_routing(context) == frontend.handle_request
+        assert context.target_frontend == "Saml2IDP"
+
+        context = Context()
+        context.path = "proxy/Saml2SP/response"
+        assert router.endpoint_routing(context) == backend.handle_response
+        assert context.target_backend == "Saml2SP"
+
+    def test_endpoint_routing_with_base_url_context_path_and_unhashable_spec(self):
+        frontend = TestFrontend(None, {"attributes": {}}, None, None, "Saml2IDP")
+        frontend.register_endpoints = lambda backend_names: [
+            ("^a/y$", [frontend.handle_request]),
+            ("^(a|b)/x$", [frontend.handle_authn_response]),
+        ]
+        backend = TestBackend(None, {"attributes": {}}, None, None, "Saml2SP")
+        router = ModuleRouter("https://satosa.example.com/proxy", [frontend], [backend], [])
+
+        context = Context()
+        context.path = "proxy/a/x"
+        assert router.endpoint_routing(context) == [frontend.handle_authn_response]
+        assert context.target_frontend == "Saml2IDP"
+
+    def test_endpoint_routing_to_base_url_context_path(self):
+        frontend = TestFrontend(None, {"attributes": {}}, None, None, "Saml2IDP")
+        frontend.register_endpoints = lambda backend_names: [("^proxy$", frontend.handle_request)]
+        backend = TestBackend(None, {"attributes": {}}, None, None, "Saml2SP")
+        router = ModuleRouter("https://satosa.example.com/proxy", [frontend], [backend], [])
+
+        context = Context()
+        context.path = "proxy"
+        assert router.endpoint_routing(context) == frontend.handle_request
+        assert context.target_frontend == "Saml2IDP"
+        assert context.target_backend is None
+
+    def test_endpoint_routing_with_base_url_trailing_slash(self):
+        router = ModuleRouter("https://satosa.example.com/",
+                              [module.instance for module in self.router.frontends.values()],
+                              [module.instance for module in self.router.backends.values()],
+                              [module.instance for module in self.router.micro_services.values()])
+        context = Context()
+        context.path = "%s/%s/request" % (BACKEND_NAMES[0], FRONTEND_NAMES[0])
+        router.endpoint_routing(context)
+        assert context.target_frontend == FRONTEND_NAMES[0]
+        assert context.target_backend == BACKEND_NAMES[0]
+
+    @pytest.mark.parametrize('regex, expected_prefix', [
+        ("^Saml2SP/acs/post$", "Saml2SP"),
+        ("^saml2\\-sp\\.v2/acs/post$", "saml2-sp.v2"),
+        ("^Saml2SP\\/$", None),
+        ("^account_linking$", "account_linking"),
+        ("^ping", None),
+        ("^Saml2SP/?$", None),
+        ("^.well-known/openid-configuration$", None),
+        ("^Saml2SP/acs|^other/acs", None),
+    ])
+    def test_endpoint_path_prefix(self, regex, expected_prefix):
+        assert _endpoint_path_prefix(re.compile(regex)) == expected_prefix
+
+    @pytest.mark.parametrize('regex, expected_path', [
+        ("^Saml2SP/acs/post$", "Saml2SP/acs/post"),
+        ("^saml2\\-sp\\.v2/acs/post$", "saml2-sp.v2/acs/post"),
+        ("^ping", None),
+        ("^Saml2SP/acs/.*$", None),
+        ("^Saml2SP/acs\\d$", None),
+    ])
+    def test_literal_endpoint_path(self, regex, expected_path):
+        assert _literal_endpoint_path(re.compile(regex)) == expected_path
+
+    def test_index_endpoints(self):
+        endpoints = [(re.compile(regex), regex, "module", "target_frontend")
+                     for regex in ["^a/x$", "^ping", "^b/x$", "^a/y$", "^.*/z$"]]
+        index = _index_endpoints(endpoints)
+        assert {prefix: [entry.spec for entry in entries] for prefix, entries in index.items()} == {
+            None: ["^ping", "^.*/z$"],
+            "a": ["^a/x$", "^ping", "^a/y$", "^.*/z$"],
+            "b": ["^ping", "^b/x$", "^.*/z$"],
+        }
+        assert [entry.pos for entry in index["a"]] == [0, 1, 3, 4]
+
+    def test_literal_endpoint_respects_routing_precedence(self):
+        frontend = TestFrontend(None, {"attributes": {}}, None, None, "Saml2IDP")
+        frontend.register_endpoints = lambda backend_names: [("^request_microservice/.*$", frontend.handle_request)]
+        backend = TestBackend(None, {"attributes": {}}, None, None, "Saml2SP")
+        microservice = TestRequestMicroservice("RequestService", base_url="https://satosa.example.com")
+        router = ModuleRouter("https://satosa.example.com", [frontend], [backend], [microservice])
+
+        context = Context()
+        context.path = "request_microservice/callback"
+        assert router.endpoint_routing(context) == frontend.handle_request
+        assert context.target_frontend == "Saml2IDP"
+        assert context.target_micro_service is None
+
+    @pytest.mark.parametrize('url_path, expected_backend', [
+        ("%s/response" % (provider,), provider) for provider in BACKEND_NAMES
+        ])
+    def test_endpoint_routing_to_literal_backend_endpoint_skips_frontends(self, url_path, expected_backend,
+                                                                          monkeypatch):
+        def fail(*args):
+            raise AssertionError("frontend and micro service endpoints should not be matched")
+
+        monkeypatch.setattr(ModuleRouter, "_match_indexed_endpoint", fail)
+        context = Context()
+        context.path = url_path
+        assert self.router.endpoint_routing(context) == self.router.backends[expected_backend].instance.handle_response
+        assert context.target_backend == expected_backend
 
     def test_endpoint_routing_with_unknown_endpoint(self, context):
         context.path = "unknown"
@@ -89,4 +231,4 @@ class TestModuleRouter:
     ])
     def test_bad_init(self, frontends, backends, micro_services):
         with pytest.raises(ValueError):
-            ModuleRouter(frontends, backends, micro_services)
+            ModuleRouter("https://satosa.example.com", frontends, backends, micro_services)